@@ -8,60 +8,253 @@ if repo_dir not in sys.path:
     sys.path.append(repo_dir)
 
 # Python modules
+import calendar
+import concurrent.futures
+import dataclasses
 import datetime
+import email.utils
+import random
+import threading
 import time
 import sys,os
-import dill as pickle
+import json
 import requests
 import cdsapi
+import xarray as xr
 
 # LS2D modules
-from ls2d_funcs import *
+from ls2d_funcs import (
+        chunk_dates, era5_file_path, get_required_analysis, lower_to_hour,
+        patch_netcdf, header, message, warning, error)
 
 #############
 # FUNCTIONS #
 #############
 
+# CDS runs ~5-6 requests concurrently per user, so submitting more workers
+# than that just queues client side.
+max_parallel_requests = 6
+
+# Polling the state of an already-submitted request is a cheap status GET and
+# does not occupy a CDS job slot, so polls can run much wider than submissions.
+max_parallel_polls = 20
+
+# API keys
+api_key = '<INSERT YOUR CDS/ADS API KEY HERE>'
+cds_url = 'https://cds.climate.copernicus.eu/api'
+ads_url = 'https://ads.atmosphere.copernicus.eu/api'
+
+# CDS/ADS dataset targeted by each file type, and the (hardcoded) variables
+# requested from it. Requests are rate limited per user, so file types that
+# target the same dataset with identical chunk dates are merged into a single
+# request (see `_merge_download_queue`) and split into separate files locally
+# after download.
+request_datasets = {
+    'surface_an' : 'reanalysis-era5-single-levels',
+    'pressure_an': 'reanalysis-era5-pressure-levels',
+    'cams'       : 'cams-global-reanalysis-eac4',
+}
+
+request_variables = {
+    'surface_an': [
+        'land_sea_mask',
+        'low_cloud_cover',
+        'toa_incident_solar_radiation'],
+    'pressure_an': [
+        'geopotential',
+        'relative_humidity',
+        'temperature'],
+    'cams': [
+        'sea_salt_aerosol_0.03-0.5um_mixing_ratio',
+        'sea_salt_aerosol_0.5-5um_mixing_ratio',
+        'sea_salt_aerosol_5-20um_mixing_ratio'],
+}
+
+# NetCDF short names of the request variables, needed to split a merged
+# download into its per-file-type datasets.
+variable_short_names = {
+    'land_sea_mask'                           : 'lsm',
+    'low_cloud_cover'                         : 'lcc',
+    'toa_incident_solar_radiation'            : 'tisr',
+    'geopotential'                            : 'z',
+    'relative_humidity'                       : 'r',
+    'temperature'                             : 't',
+    'sea_salt_aerosol_0.03-0.5um_mixing_ratio': 'aermr01',
+    'sea_salt_aerosol_0.5-5um_mixing_ratio'   : 'aermr02',
+    'sea_salt_aerosol_5-20um_mixing_ratio'    : 'aermr03',
+}
+
+# Per-thread log file handles, so each download worker writes to its own
+# .out/.err file without touching the log of another worker.
+_thread_log = threading.local()
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class DLSettings:
+    """
+    Download settings, one instance per queue entry. A frozen dataclass
+    instead of a dict: attribute access beats dict lookups in the per-chunk
+    hot path, a typo in a field name fails loudly instead of silently adding a
+    key, and per-chunk variants are derived with `dataclasses.replace`.
+    See `_download_era5_file` for a description of the fields.
+    """
+
+    start_date: datetime.datetime
+    end_date: datetime.datetime
+    era5_path: str
+    case_name: str
+    write_log: bool
+    chunk_strategy: object              # 'month' or number of days per chunk
+    delete_expired_requests: bool
+    delete_rejected_requests: bool
+    format: str
+    patch_netcdf: bool
+
+    # Domain: EITHER the bounding box, OR central point + area size.
+    lat_n: float = None
+    lat_s: float = None
+    lon_w: float = None
+    lon_e: float = None
+    central_lat: float = None
+    central_lon: float = None
+    area_size: float = None
+
+    # File types to exclude from the download.
+    blacklist_download: tuple = ()
+
+    # Derived from `format` in `download_era5`:
+    format_extension: str = None
+
+    # Per-chunk fields, set in `prep_dl` / `_merge_download_queue`:
+    chunk_dates: list = None
+    ftype: str = None
+    merged_ftypes: list = None
+    nc_dir: str = None
+    nc_file: str = None
+    out_file: str = None
+    err_file: str = None
+    request_file: str = None
+
+    # Background patching pool and its futures, shared by all queue entries:
+    patch_pool: object = None
+    patch_futures: list = None
+
+
 class Tee:
     """
     Logging in file and terminal simultaneously.
+    The log file is looked up per thread (see `_thread_log`), so the Tee can be
+    installed once on sys.stdout/sys.stderr and still keep the output of
+    parallel download workers in separate files.
     """
-    def __init__(self, *streams):
-        self.streams = streams
+    def __init__(self, terminal, log_attr):
+        self.terminal = terminal
+        self.log_attr = log_attr    # 'out' or 'err'
+
+    def streams(self):
+        log_file = getattr(_thread_log, self.log_attr, None)
+        if log_file is None:
+            return (self.terminal,)
+        return (self.terminal, log_file)
 
     def write(self, data):
-        for s in self.streams:
+        for s in self.streams():
             s.write(data)
             s.flush()
 
     def flush(self):
-        for s in self.streams:
+        for s in self.streams():
             s.flush()
 
 
-def chunk_dates(dates, chunk_size):
+def _set_chunk_paths(req):
     """
-    Splits list of dates into lists of chunk_size.
-    Prevents chunks from crossing between months (as this is not allowed by CDS API).
+    Compute the output/log/state file paths of a queue entry once, instead of
+    re-deriving them in every function that needs them. Returns a new
+    DLSettings instance with the path fields filled in.
     """
-    chunks, chunk = [], []
-    for d in dates:
-        if not chunk:
-            chunk.append(d)
-            continue
-
-        same_month = (d.month == chunk[-1].month)
-        chunk_size_reached = (len(chunk) >= chunk_size)
-
-        if (not same_month) or chunk_size_reached:
-            chunks.append(chunk)
-            chunk = [d]
-        else:
-            chunk.append(d)
+    nc_dir, nc_file = era5_file_path(
+            req.chunk_dates,
+            req.era5_path, req.case_name, req.ftype, req.format_extension)
+
+    file_stem = nc_file[:-len(req.format_extension)]
+
+    return dataclasses.replace(
+            req, nc_dir=nc_dir, nc_file=nc_file,
+            out_file='{}.out'.format(file_stem),
+            err_file='{}.err'.format(file_stem),
+            request_file='{}.json'.format(file_stem))
+
+
+# One shared client per API url: each cdsapi.Client owns a requests.Session,
+# so reusing it pools the HTTPS connections (one TLS handshake per host
+# instead of one per chunk).
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def _get_server(url):
+    """
+    Return the shared cdsapi.Client for `url`, creating it on first use.
+    """
+    with _servers_lock:
+        if url not in _servers:
+            _servers[url] = cdsapi.Client(
+                    wait_until_complete=False, delete=False, url=url, key=api_key)
+        return _servers[url]
+
+
+def _parse_retry_after(retry_after):
+    """
+    Parse a Retry-After header value into seconds. RFC 9110 allows both a
+    delta-seconds and an HTTP-date form; returns None when absent/unparsable.
+    """
+    if retry_after is None:
+        return None
+
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
 
-    if chunk:
-        chunks.append(chunk)
-    return chunks
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_date.tzinfo is None:
+        retry_date = retry_date.replace(tzinfo=datetime.timezone.utc)
+
+    return max(0., (retry_date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def _save_era5_request(cds_request, url, request_file):
+    """
+    Persist a submitted CDS/ADS request as JSON. Only the request id and API
+    url are needed to pick the request up again later, so there is no point in
+    pickling the full client/session object graph.
+    """
+    with open(request_file, 'w') as f:
+        json.dump({'request_id': cds_request.reply['request_id'], 'url': url}, f)
+
+
+def _restore_era5_request(request_file):
+    """
+    Reconstruct a CDS/ADS request object from a JSON file written by
+    `_save_era5_request`. Raises requests.exceptions.HTTPError if the request
+    is no longer available online.
+    """
+    with open(request_file, 'r') as f:
+        request_state = json.load(f)
+
+    server = _get_server(request_state['url'])
+
+    # The Remote returned by the datastores client already provides the legacy
+    # update()/reply/download() interface (including the legacy state names),
+    # so it is used as-is. Wrapping it in cdsapi.api.Result would route
+    # update() to the old /tasks endpoint, which no longer exists on the
+    # post-2024 CDS.
+    return server.client.get_remote(request_state['request_id'])
 
 
 def _download_era5_file(settings):
@@ -69,18 +262,21 @@ def _download_era5_file(settings):
     Download ERA5 analysis or forecasts on surface or pressure levels
 
     Arguments:
-        settings : dictionary
-            Dictionary with keys:
+        settings : DLSettings
+            Settings instance with fields:
                 chunk_dates                 : list of datetime objects with dates to download
                 era5_path                   : absolute or relative path to save the NetCDF data
                 case_name                   : case name used in file name of NetCDF files
                 format_extension            : file extension based on format ('.nc' or '.grib')
                 format                      : data format ('netcdf' or 'grib')
                 write_log                   : boolean, whether to write to log files or not
-                delete_expired_requests     : boolean, whether to delete pickles of expired requests
-                delete_rejected_requests    : boolean, whether to delete pickles of rejected requests
+                delete_expired_requests     : boolean, whether to delete state files of expired requests
+                delete_rejected_requests    : boolean, whether to delete state files of rejected requests
                 patch_netcdf                : boolean, whether to patch NetCDF files to old CDS format
                 ftype                       : level/forecast/analysis switch (in: [model_an, model_fc, pressure_an, surface_an])
+                nc_dir, nc_file             : output directory and file of the chunk (set by `_set_chunk_paths`)
+                out_file, err_file          : log file paths (set by `_set_chunk_paths`)
+                request_file                : request state file path (set by `_set_chunk_paths`)
 
                 lat_n, lat_s, lon_w, lon_e  : bounding box of requested area
                 -OR-
@@ -89,139 +285,181 @@ def _download_era5_file(settings):
 
     """
 
-    # API keys
-    api_key = '<INSERT YOUR CDS/ADS API KEY HERE>'
-    cds_url = 'https://cds.climate.copernicus.eu/api'
-    ads_url = 'https://ads.atmosphere.copernicus.eu/api'
-
-    # Keep track of CDS downloads which are finished:
-    finished = False
-    state = 'new'
+    # Create the output directory just before writing anything to it
+    # (existence of all chunk directories is checked once in `download_era5`).
+    if not os.path.isdir(settings.nc_dir):
+        message('Creating output directory {}'.format(settings.nc_dir))
+        os.makedirs(settings.nc_dir, exist_ok=True)
 
-    # Output file name
-    nc_dir, nc_file = era5_file_path(
-            settings['chunk_dates'],
-            settings['era5_path'], settings['case_name'], settings['ftype'], settings['format_extension'])
+    if not settings.write_log:
+        return _process_era5_request(settings)
 
+    # Write CDS API prints to log file (NetCDF file path/name appended with .out/.err).
+    # The handles are registered per thread, so parallel workers log to their own files.
+    with open(settings.out_file, 'w') as stdout_file, open(settings.err_file, 'w') as stderr_file:
+        _thread_log.out = stdout_file
+        _thread_log.err = stderr_file
+        try:
+            return _process_era5_request(settings)
+        finally:
+            _thread_log.out = None
+            _thread_log.err = None
 
-    # Write CDS API prints to log file (NetCDF file path/name appended with .out/.err)
-    if settings['write_log']:
-        # Tee allows output to go to terminal and file simultaneously
 
-        out_file   = '{}.out'.format(nc_file[:-len(settings['format_extension'])])
-        err_file   = '{}.err'.format(nc_file[:-len(settings['format_extension'])])
+def _process_era5_request(settings):
+    """
+    Check/submit/download a single CDS/ADS request (see `_download_era5_file`).
+    """
 
-        stdout_file = open(out_file, "w")
-        stderr_file = open(err_file, "w")
+    # Keep track of CDS downloads which are finished:
+    finished = False
+    state = 'new'
 
-        sys.stdout = Tee(sys.__stdout__, stdout_file)
-        sys.stderr = Tee(sys.__stderr__, stderr_file)
+    # Sleep duration requested by the server (HTTP 429 Retry-After), if any:
+    retry_after = None
 
 
     # Bounds of domain (Yunpei mod)
-    if all(k in settings for k in ('lat_n', 'lat_s', 'lon_w', 'lon_e')):
+    if None not in (settings.lat_n, settings.lat_s, settings.lon_w, settings.lon_e):
         message('Using pre-defined bounding box from settings.')
-        lat_n = settings['lat_n']
-        lat_s = settings['lat_s']
-        lon_w = settings['lon_w']
-        lon_e = settings['lon_e']
+        lat_n = settings.lat_n
+        lat_s = settings.lat_s
+        lon_w = settings.lon_w
+        lon_e = settings.lon_e
     # Fallback to original central lat/lon + size logic
-    elif all(k in settings for k in ('central_lat', 'central_lon', 'area_size')):
+    elif None not in (settings.central_lat, settings.central_lon, settings.area_size):
         message('Calculating bounding box from central point and area size.')
-        lat_n = settings['central_lat'] + settings['area_size']
-        lat_s = settings['central_lat'] - settings['area_size']
-        lon_w = settings['central_lon'] - settings['area_size']
-        lon_e = settings['central_lon'] + settings['area_size']
+        lat_n = settings.central_lat + settings.area_size
+        lat_s = settings.central_lat - settings.area_size
+        lon_w = settings.central_lon - settings.area_size
+        lon_e = settings.central_lon + settings.area_size
     else:
         error('Domain boundaries are not correctly defined in settings. '
                 'Please provide EITHER (lat_n, lat_s, lon_w, lon_e) '
                 'OR (central_lat, central_lon, area_size).', exit=True)
 
 
-    # Check if pickle with previous request is available.
-    # If so, try to download NetCDF file, if not, submit new request
-    pickle_file = '{}.pickle'.format(nc_file[:-len(settings['format_extension'])])
+    # Output and request state file, computed once in `_set_chunk_paths`:
+    nc_file      = settings.nc_file
+    request_file = settings.request_file
 
-    if os.path.isfile(pickle_file):
+    # Check if state file with previous request is available.
+    # If so, try to download NetCDF file, if not, submit new request
+    if os.path.isfile(request_file):
         message('Found previous CDS/AMS request!')
 
-        with open(pickle_file, 'rb') as f:
-            cds_request = pickle.load(f)
+        try:
+            cds_request = _restore_era5_request(request_file)
+            cds_request.update()
+        except requests.exceptions.HTTPError as e:
 
-            try:
-                cds_request.update()
-            except requests.exceptions.HTTPError:
+            response = getattr(e, 'response', None)
+            if response is not None and response.status_code == 429:
+                # We are being rate limited; honor the server's Retry-After
+                # instead of re-polling aggressively (rejected polls count
+                # against the request quota).
+                retry_after = _parse_retry_after(response.headers.get('Retry-After'))
+                warning('Rate limited by CDS/ADS (HTTP 429), Retry-After = {} s'.format(retry_after))
+                return finished, retry_after
 
-                error('CDS/AMS request is no longer available online!', exit=False)
-                error('To continue, delete the previous request: {}'.format(pickle_file), exit=settings['delete_expired_requests']^True)
+            error('CDS/AMS request is no longer available online!', exit=False)
+            error('To continue, delete the previous request: {}'.format(request_file), exit=settings.delete_expired_requests^True)
 
-                if settings['delete_expired_requests']:
-                    os.remove(pickle_file)
-                    message('Deleted expired request pickle file.')
-                    state = 'deleted'
+            if settings.delete_expired_requests:
+                os.remove(request_file)
+                message('Deleted expired request state file.')
+                state = 'deleted'
 
-            if state != 'deleted':
-                state = cds_request.reply['state']
+        if state != 'deleted':
+            state = cds_request.reply['state']
 
-            header('Downloading: {}-{} \t | {} \t | {}'.format(settings['chunk_dates'][0].strftime('%Y/%m/%d'), settings['chunk_dates'][-1].strftime('%d'), settings['ftype'], state))
+        header('Downloading: {}-{} \t | {} \t | {}'.format(settings.chunk_dates[0].strftime('%Y/%m/%d'), settings.chunk_dates[-1].strftime('%d'), settings.ftype, state))
 
-            if state == 'completed':
-                message('Request finished, downloading NetCDF/Grib file')
+        if state == 'completed':
+            message('Request finished, downloading NetCDF/Grib file')
 
-                cds_request.download(nc_file)
-                f.close()
-                os.remove(pickle_file)
+            cds_request.download(nc_file)
+            os.remove(request_file)
 
-                # Patch NetCDF file, to make the (+/-) identical to the old CDS
-                # files, and files retrieved from MARS.
-                if settings['patch_netcdf'] and (settings['format'] == 'netcdf'):
-                    message('Patching NetCDF file to old CDS format') # not sure if this works with CAMS?
-                    patch_netcdf(nc_file)
+            # Split a merged (multi file type) download into its per-type files.
+            if settings.merged_ftypes is not None and len(settings.merged_ftypes) > 1:
+                nc_files = _split_merged_file(settings, nc_file)
+            else:
+                nc_files = [nc_file]
 
-                finished = True
+            # Patch NetCDF file(s), to make the (+/-) identical to the old CDS
+            # files, and files retrieved from MARS. The CPU-bound patching runs
+            # in a worker process, overlapping with the remaining downloads.
+            # The pool only exists when patching is enabled for NetCDF output
+            # (decided once in `download_era5`), so Grib runs skip this
+            # without re-evaluating the format per chunk.
+            if settings.patch_pool is not None:
+                for nc_f in nc_files:
+                    message('Patching NetCDF file to old CDS format in the background') # not sure if this works with CAMS?
+                    settings.patch_futures.append(
+                            settings.patch_pool.submit(patch_netcdf, nc_f))
 
-            elif state in ('queued', 'accepted', 'running'):
-                message('Request not finished, current status = \"{}\"'.format(state))
+            finished = True
 
-            elif state == 'deleted':
-                message('Deleted, skipping')
+        elif state in ('queued', 'accepted', 'running'):
+            message('Request not finished, current status = \"{}\"'.format(state))
 
-            else:
-                error('Request failed, status = \"{}\"'.format(state), exit=False)
-                try:
-                    message('Error message = {}'.format(cds_request.reply['error'].get('message')))
-                    message('Error reason = {}'.format(cds_request.reply['error'].get('reason')))
-                except Exception:
-                    message('Rejected for unknown reason.')
-                    
-                if settings['delete_rejected_requests']:
-                    os.remove(pickle_file)
-                    os.remove('{}.err'.format(nc_file[:-len(settings['format_extension'])]))
-                    os.remove('{}.out'.format(nc_file[:-len(settings['format_extension'])]))
-
-                    message('Deleted rejected request files.')
+        elif state == 'deleted':
+            message('Deleted, skipping')
+
+        else:
+            error('Request failed, status = \"{}\"'.format(state), exit=False)
+            try:
+                message('Error message = {}'.format(cds_request.reply['error'].get('message')))
+                message('Error reason = {}'.format(cds_request.reply['error'].get('reason')))
+            except Exception:
+                message('Rejected for unknown reason.')
+
+            if settings.delete_rejected_requests:
+                os.remove(request_file)
+                os.remove(settings.err_file)
+                os.remove(settings.out_file)
+
+                message('Deleted rejected request files.')
 
     else:
 
-        header('Downloading: {}-{} \t | {} \t | {}'.format(settings['chunk_dates'][0].strftime('%Y/%m/%d'), settings['chunk_dates'][-1].strftime('%d'), settings['ftype'], state))
+        header('Downloading: {}-{} \t | {} \t | {}'.format(settings.chunk_dates[0].strftime('%Y/%m/%d'), settings.chunk_dates[-1].strftime('%d'), settings.ftype, state))
         message('No previous CDS/AMS request, submitting new one')
 
+        # File type(s) covered by this request, and the combined variable list.
+        ftypes = settings.merged_ftypes if settings.merged_ftypes is not None else [settings.ftype]
+        dataset = request_datasets[ftypes[0]]
+        variables = [v for ftype in ftypes for v in request_variables[ftype]]
+
         analysis_times = ['{0:02d}:00'.format(i) for i in range(24)]
         area = [lat_n, lon_w, lat_s, lon_e]
 
+        # Day list for the ERA5 datasets. For a chunk covering a full calendar
+        # month, request all days explicitly (the CDS 'day=all' recommendation).
+        year  = settings.chunk_dates[0].year
+        month = settings.chunk_dates[0].month
+        n_days_month = calendar.monthrange(year, month)[1]
+
+        if len(settings.chunk_dates) == n_days_month:
+            days = ['{0:02d}'.format(d) for d in range(1, n_days_month + 1)]
+        else:
+            days = [date.day for date in settings.chunk_dates]
+
         request = {
-            'format': settings['format'],
+            'format': settings.format,
             'time': analysis_times,
             'area': area,
-            'grid': [1.0, 1.0]
+            'grid': [1.0, 1.0],
+            'variable': variables
         }
 
-        if settings['ftype'] == 'pressure_an':
+        if dataset == 'reanalysis-era5-pressure-levels':
 
-            # Create instance of CDS API
-            server = cdsapi.Client(wait_until_complete=False, delete=False, url=cds_url, key=api_key)
+            # Shared instance of CDS API
+            server = _get_server(cds_url)
 
-            # Hardcoded pressure levels and variables
+            # Hardcoded pressure levels
             pressure_levels = [
                 # '1', '2', '3', '5', '7',
                 # '10', '20', '30', '50', '70',
@@ -239,60 +477,85 @@ def _download_era5_file(settings):
             request.update({
                 'product_type': 'reanalysis',
                 'pressure_level': pressure_levels,
-                'year': '{0:04d}'.format(settings['chunk_dates'][0].year),
-                'month': '{0:02d}'.format(settings['chunk_dates'][0].month),
-                'day': [date.day for date in settings['chunk_dates']],
-                'variable': [
-                    'geopotential',
-                    'relative_humidity',
-                    'temperature'
-                ]})
-
-            cds_request = server.retrieve('reanalysis-era5-pressure-levels', request)
+                'year': '{0:04d}'.format(year),
+                'month': '{0:02d}'.format(month),
+                'day': days})
 
-        elif settings['ftype'] == 'surface_an':
+        elif dataset == 'reanalysis-era5-single-levels':
 
-            # Create instance of CDS API
-            server = cdsapi.Client(wait_until_complete=False, delete=False, url=cds_url, key=api_key)
+            # Shared instance of CDS API
+            server = _get_server(cds_url)
 
-            # Hardcoded variables
             request.update({
                 'product_type': 'reanalysis',
-                'year': '{0:04d}'.format(settings['chunk_dates'][0].year),
-                'month': '{0:02d}'.format(settings['chunk_dates'][0].month),
-                'day': [date.day for date in settings['chunk_dates']],
-                'variable': [
-                    'land_sea_mask',
-                    'low_cloud_cover',
-                    'toa_incident_solar_radiation'
-                ]})
+                'year': '{0:04d}'.format(year),
+                'month': '{0:02d}'.format(month),
+                'day': days})
 
-            cds_request = server.retrieve('reanalysis-era5-single-levels', request)
+        elif dataset == 'cams-global-reanalysis-eac4':
 
-        elif settings['ftype'] == 'cams':
+            # Shared instance of ADS API
+            server = _get_server(ads_url)
 
-            # Create instance of ADS API
-            server = cdsapi.Client(wait_until_complete=False, delete=False, url=ads_url, key=api_key)
+            dates_str = [d.strftime("%Y-%m-%d") for d in settings.chunk_dates]
 
-            dates_str = [d.strftime("%Y-%m-%d") for d in settings['chunk_dates']]
-
-            # Hardcoded variables
             request.update({
                 'pressure_level': ['1000'],
-                'date': dates_str,
-                'variable': [
-                    'sea_salt_aerosol_0.03-0.5um_mixing_ratio',
-                    'sea_salt_aerosol_0.5-5um_mixing_ratio',
-                    'sea_salt_aerosol_5-20um_mixing_ratio',
-                ]})
-            
-            cds_request = server.retrieve('cams-global-reanalysis-eac4', request)
+                'date': dates_str})
+
+        cds_request = server.retrieve(dataset, request)
+
+        # Save request state for later processing/download
+        _save_era5_request(cds_request, server.url, request_file)
 
-        # Save pickle for later processing/download
-        with open(pickle_file, 'wb') as f:
-            pickle.dump(cds_request, f)
+    return finished, retry_after
 
-    return finished
+
+def _split_merged_file(settings, nc_file):
+    """
+    Split a merged (multi file type) NetCDF download into one file per file
+    type, and remove the merged file. Returns the per-type file paths.
+    """
+
+    nc_files = []
+    with xr.open_dataset(nc_file, decode_times=False) as ds:
+        for ftype in settings.merged_ftypes:
+            _, ftype_file = era5_file_path(
+                    settings.chunk_dates,
+                    settings.era5_path, settings.case_name, ftype, settings.format_extension)
+
+            message('Splitting {} from merged download'.format(ftype_file))
+            short_names = [variable_short_names[v] for v in request_variables[ftype]]
+            ds[short_names].to_netcdf(ftype_file)
+            nc_files.append(ftype_file)
+
+    os.remove(nc_file)
+    return nc_files
+
+
+def _merge_download_queue(download_queue):
+    """
+    Merge queue entries that target the same CDS/ADS dataset with identical
+    chunk dates into a single request, so they occupy one slot in the
+    (per-user rate limited) CDS queue instead of several. The merged download
+    is split into per-type files by `_split_merged_file`.
+    """
+
+    merged = {}
+    for req in download_queue:
+        key = (request_datasets[req.ftype], tuple(req.chunk_dates))
+
+        if key in merged:
+            merged_ftypes = sorted(merged[key].merged_ftypes + [req.ftype])
+            # Merged requests get a combined file type, so their state/log
+            # files cannot collide with those of a single-type request.
+            first = dataclasses.replace(
+                    merged[key], merged_ftypes=merged_ftypes, ftype='+'.join(merged_ftypes))
+            merged[key] = _set_chunk_paths(first)
+        else:
+            merged[key] = dataclasses.replace(req, merged_ftypes=[req.ftype])
+
+    return list(merged.values())
 
 
 def download_era5(settings, exit_when_waiting=True):
@@ -319,40 +582,54 @@ def download_era5(settings, exit_when_waiting=True):
             Case name used in file name of NetCDF files
     """
 
-    header('Downloading ERA5 for period: {} to {}'.format(settings['start_date'], settings['end_date']))
+    header('Downloading ERA5 for period: {} to {}'.format(settings.start_date, settings.end_date))
 
-    if settings['format'] == 'netcdf':
-        settings['format_extension'] = '.nc'
-    elif settings['format'] == 'grib':
-        settings['format_extension'] = '.grib'
+    if settings.format == 'netcdf':
+        settings = dataclasses.replace(settings, format_extension='.nc')
+    elif settings.format == 'grib':
+        settings = dataclasses.replace(settings, format_extension='.grib')
 
     # Check if output directory exists, and ends with '/'
-    if not os.path.isdir(settings['era5_path']):
-        error('Output directory \"{}\" does not exist!'.format(settings['era5_path']))
-    if settings['era5_path'][-1] != '/':
-        settings['era5_path'] += '/'
+    if not os.path.isdir(settings.era5_path):
+        error('Output directory \"{}\" does not exist!'.format(settings.era5_path))
+    if settings.era5_path[-1] != '/':
+        settings = dataclasses.replace(settings, era5_path=settings.era5_path + '/')
 
     if cdsapi is None:
         error('CDS API is not installed. See: https://cds.climate.copernicus.eu/api-how-to')
 
     # Round date/time to full hours
-    start = lower_to_hour(settings['start_date'])
-    end   = lower_to_hour(settings['end_date']  )
+    start = lower_to_hour(settings.start_date)
+    end   = lower_to_hour(settings.end_date)
 
     # Get list of required forecast and analysis times
     an_dates = get_required_analysis(start, end)
     # fc_dates = era_tools.get_required_forecast(start, end)
 
-    # Base dictionary to pass to download function. In Python >3.3, multiprocessings Pool() can accept
-    # multiple arguments. For now, keep it generic for older versions by passing all arguments inside a dict.
-    download_settings = settings.copy()
     download_queue = []
 
+    # Pool for patching downloaded NetCDF files in the background: patching is
+    # CPU-bound and would otherwise serialize with the network-bound downloads.
+    # The pool and futures list are shared by all per-chunk settings instances.
+    patch_pool = None
+    patch_futures = []
+    if settings.patch_netcdf and (settings.format == 'netcdf'):
+        patch_pool = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+
+    # Base settings to derive the per-chunk download settings from.
+    download_settings = dataclasses.replace(
+            settings, patch_pool=patch_pool, patch_futures=patch_futures)
+
     # Option to exclude download types.
-    if 'blacklist_download' in settings:
-        blacklist = settings['blacklist_download']
-    else:
-        blacklist = []
+    blacklist = settings.blacklist_download
+
+    # Scan the case directory once, instead of stat'ing every chunk file in
+    # `prep_dl` below. For multi-year downloads this replaces thousands of
+    # isfile/exists syscalls with a single directory walk.
+    existing_files = set()
+    for walk_dir, _, walk_files in os.walk('{}/{}'.format(settings.era5_path, settings.case_name)):
+        for walk_file in walk_files:
+            existing_files.add('{}/{}'.format(walk_dir, walk_file))
 
     # Loop over all required files, check if there is a local version, if not add to download queue
     def prep_dl(chunk_size, ftype):
@@ -361,31 +638,67 @@ def download_era5(settings, exit_when_waiting=True):
 
         for dates in chunked_dates:
             if ftype not in blacklist:
-                era_dir, era_file = era5_file_path(
-                        dates, settings['era5_path'], settings['case_name'], ftype, settings['format_extension'])
-                
-                if not os.path.exists(era_dir):
-                    message('Creating output directory {}'.format(era_dir))
-                    os.makedirs(era_dir)
-
-                if os.path.isfile(era_file):
-                    message('Found {} - {} local'.format(era_file, ftype))
+                settings_tmp = dataclasses.replace(
+                        download_settings, chunk_dates=dates, ftype=ftype)
+                settings_tmp = _set_chunk_paths(settings_tmp)
+
+                if settings_tmp.nc_file in existing_files:
+                    message('Found {} - {} local'.format(settings_tmp.nc_file, ftype))
                 else:
-                    settings_tmp = download_settings.copy()
-                    settings_tmp.update({'chunk_dates': dates, 'ftype': ftype})
                     download_queue.append(settings_tmp)
 
-    prep_dl(settings['chunk_size_sl'], 'surface_an')
-    prep_dl(settings['chunk_size_pl'], 'pressure_an')
-    prep_dl(settings['chunk_size_cams'], 'cams')
-
-    finished = True
-    any_dl = False
+    # All file types share one chunk strategy, so their chunk boundaries line
+    # up and same-dataset requests can be merged below.
+    prep_dl(settings.chunk_strategy, 'surface_an')
+    prep_dl(settings.chunk_strategy, 'pressure_an')
+    prep_dl(settings.chunk_strategy, 'cams')
+
+    # Merge same-dataset/same-dates requests into one CDS request (NetCDF only;
+    # a merged Grib file cannot be split into per-type files with Xarray).
+    if settings.format == 'netcdf':
+        download_queue = _merge_download_queue(download_queue)
+
+    # Tee allows output to go to terminal and file simultaneously. Installed
+    # once; each worker thread registers its own log files via `_thread_log`.
+    if settings.write_log and not isinstance(sys.stdout, Tee):
+        sys.stdout = Tee(sys.__stdout__, 'out')
+        sys.stderr = Tee(sys.__stderr__, 'err')
+
+    # Split the queue into status polls of previously submitted requests and
+    # new submissions, so the cheap polls are not throttled by the submission
+    # concurrency limit.
+    poll_queue, submit_queue = [], []
     for req in download_queue:
-        if not _download_era5_file(req):
-            finished = False
+        if req.request_file in existing_files:
+            poll_queue.append(req)
         else:
-            any_dl = True
+            submit_queue.append(req)
+
+    # Submit/poll the requests in parallel. CDS processes several requests per
+    # user concurrently, and each submission is network-bound, so overlapping
+    # them keeps the server-side queue filled. Polls of N pending requests run
+    # in ~N/max_parallel_polls round trips instead of N serial ones.
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel_polls) as executor:
+        results += list(executor.map(_download_era5_file, poll_queue))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel_requests) as executor:
+        results += list(executor.map(_download_era5_file, submit_queue))
+
+    # Wait for background patch jobs started by completed downloads.
+    if patch_pool is not None:
+        if patch_futures:
+            message('Waiting for {} background patch job(s)'.format(len(patch_futures)))
+        concurrent.futures.wait(patch_futures)
+        patch_pool.shutdown()
+        for future in patch_futures:
+            future.result()     # Re-raise patch errors, if any.
+
+    finished = all(f for f, _ in results)
+    any_dl = any(f for f, _ in results)
+
+    # Longest Retry-After requested by the server during this cycle (None if
+    # no request was rate limited):
+    retry_after = max((r for _, r in results if r is not None), default=None)
 
     if not finished:
         print(' ---------------------------------------------------------')
@@ -401,21 +714,23 @@ def download_era5(settings, exit_when_waiting=True):
             sys.exit(0)
         print(' ---------------------------------------------------------')
 
-    return finished, any_dl
+    return finished, any_dl, retry_after
 
 if __name__ == "__main__":
 
-    # Chunk size is the size in days to split up the download requests.
-    # Larger chunks should be more efficient, both due to the queue limit on the API and presumably the overhead of each request.
-    # However, very larger chunks are deprioritised in the CDS queue, so there is probably a sweet spot.
-    # Very large chunks (most likely when requesting many pressure levels) can also be rejected by the API outright due to the size limit -
-    # but this limit can easily be found through trial and error by pushing the chunk size until you get an error.
+    # Chunk strategy controls how the download requests are split up in time.
+    # 'month' (the CDS recommendation for hourly data) requests one calendar month per chunk,
+    # so each chunk occupies a single slot in the per-user limited CDS queue.
+    # An integer requests chunks of that many days instead; smaller chunks are prioritised in
+    # the CDS queue, and very large chunks (most likely when requesting many pressure levels)
+    # can be rejected outright due to the size limit - that limit can be found through
+    # trial and error by pushing the chunk size until you get an error.
 
     finished = False
     any_dl = True
 
     sleeptime = sleeptime_init = 10 # seconds
-    sleeptime_increments = [10, 60, 300, 1800]
+    sleeptime_max = 1800 # seconds
     start = time.time()
     dl_start = time.time()
 
@@ -423,48 +738,45 @@ if __name__ == "__main__":
 
         header("Starting download cycle")
 
-        settings = {
-                'start_date'                : datetime.datetime(2010, 1, 1, 0),
-                'end_date'                  : datetime.datetime(2011, 12, 31, 23),
-                'lat_n' : 60, 'lat_s': -60,
-                'lon_w': -180, 'lon_e': 180,
-                'era5_path'                 : '/data',
-                'case_name'                 : 'test_case',
-                'write_log'                 : True,
-                # 'blacklist_download'      : 'model_an', # model_an no longer in script but can be used to exclude surface_an / pressure_an / cams
-                'chunk_size_sl'             : 8,
-                'chunk_size_pl'             : 8,
-                'chunk_size_cams'           : 8,
-                'delete_expired_requests'   : True,     # this has to be done manually if False
-                'delete_rejected_requests'  : True,     # this has to be done manually if False
-                'format'                    : 'grib',   # netcdf/grib (grib allows for more data to be downloaded at once as the filetype doesn't have to be converted in CDS)
-                'patch_netcdf'              : False,    # only applies if format is netcdf
-            }
-
-        finished, any_dl = download_era5(settings, exit_when_waiting=False)
+        settings = DLSettings(
+                start_date                  = datetime.datetime(2010, 1, 1, 0),
+                end_date                    = datetime.datetime(2011, 12, 31, 23),
+                lat_n=60, lat_s=-60,
+                lon_w=-180, lon_e=180,
+                era5_path                   = '/data',
+                case_name                   = 'test_case',
+                write_log                   = True,
+                # blacklist_download        = ('model_an',), # model_an no longer in script but can be used to exclude surface_an / pressure_an / cams
+                chunk_strategy              = 'month',  # 'month' or number of days per chunk
+
+                delete_expired_requests     = True,     # this has to be done manually if False
+                delete_rejected_requests    = True,     # this has to be done manually if False
+                format                      = 'grib',   # netcdf/grib (grib allows for more data to be downloaded at once as the filetype doesn't have to be converted in CDS)
+                patch_netcdf                = False,    # only applies if format is netcdf
+            )
+
+        finished, any_dl, retry_after = download_era5(settings, exit_when_waiting=False)
 
         if not finished:
 
             if any_dl:
                 dl_start = time.time()
                 sleeptime = sleeptime_init
-                i = 0
-            
+
             else:
                 dl_end = time.time()
                 time_since_last_dl = dl_end - dl_start
                 header(f"Time without successful DL = {time_since_last_dl:.2f} s")
 
-                # Uncomment if you want to dynamically adjust wait times between queries (to not spam your CDS UI with loads of failed requests when downloading larger files)
-                # There doesn't seem to be a reason to use this other than that - and the courtesy of not spamming the API.
-                # You can play aorund with this e.g. by using a fixed increment, a multiplier or different specified wait times.
-                
-                # if time_since_last_dl > sleeptime + sleeptime_init:
-                #     sleeptime = sleeptime_increments[i]
-                #     i=i+1
+                # Exponential backoff: double the wait on every idle cycle (capped at
+                # sleeptime_max), but never re-poll before a server-requested Retry-After.
+                sleeptime = min(max(retry_after or 0, sleeptime * 2), sleeptime_max)
+
+            # Add jitter so restarted instances don't re-poll in lockstep.
+            sleep = sleeptime + random.uniform(0, sleeptime * 0.1)
 
-            header(f"Sleeping {sleeptime:.2f} s")
-            time.sleep(sleeptime)
+            header(f"Sleeping {sleep:.2f} s")
+            time.sleep(sleep)
 
     end = time.time()
     total_time = end - start
@@ -2,8 +2,8 @@
 # Python modules
 import datetime
 import sys,os
+import numpy as np
 import xarray as xr
-import shutil
 
 
 #--------------#
@@ -84,6 +84,22 @@ def era5_file_path(dates, path, case, ftype, format_ext, return_dir=True):
     else:
         return era_file
 
+# Dimension/variable renames applied by `patch_netcdf`, per file name. One
+# dict lookup instead of chained list-membership tests, and new file types
+# only need an extra entry here.
+_rename_map = {
+    'model_an.nc'   : {'model_level': 'level', 'valid_time': 'time'},
+    'eac4_ml.nc'    : {'model_level': 'level', 'valid_time': 'time'},
+    'egg4_ml.nc'    : {'model_level': 'level', 'valid_time': 'time'},
+    'pressure_an.nc': {'pressure_level': 'level', 'valid_time': 'time'},
+    'surface_an.nc' : {'valid_time': 'time'},
+    'surface_fc.nc' : {'valid_time': 'time'},
+    'eac4_sfc.nc'   : {'valid_time': 'time'},
+    'egg4_sfc.nc'   : {'valid_time': 'time'},
+    'egg4_sl.nc'    : {'valid_time': 'time'},
+}
+
+
 # from patch_cds_ads
 def patch_netcdf(nc_file_path):
     """
@@ -94,15 +110,25 @@ def patch_netcdf(nc_file_path):
 
     NOTE: the patched files are not 100% identical to the old format, just
     identical enough for (LS)2D to read and parse them.
+
+    The file is rewritten rather than edited in place: renaming
+    dimension-scale variables (valid_time/pressure_level) in place with
+    netCDF4 triggers the long-standing netCDF-C/HDF5 rename bug, where the
+    renamed coordinates read back as fill values after reopening. The original
+    is read lazily in time chunks (dask), the patched file is streamed to a
+    temporary sibling, and the temporary atomically replaces the original on
+    success. If patching fails partway, the temporary is discarded and the
+    original stays untouched, so no separate `.unpatched` backup is needed.
     """
 
-    # Backup old file, and remove original.
-    backup_file_path = f'{nc_file_path}.unpatched'
-    shutil.copyfile(nc_file_path, backup_file_path)
-    os.remove(nc_file_path)
+    file_name = os.path.basename(nc_file_path)
 
-    # Edit with Xarray. Read the copied file, so that we can overwrite the original one.
-    ds = xr.open_dataset(backup_file_path, decode_times=False)
+    if file_name not in _rename_map:
+        error('Not a valid file type!')
+
+    # Edit with Xarray. Open lazily in time chunks (dask), so the variables
+    # are streamed to the patched file instead of loaded in memory.
+    ds = xr.open_dataset(nc_file_path, decode_times=False, chunks={'valid_time': 24})
 
     # Check if we actually have a new NetCDF file.
     if 'valid_time' not in ds.dims:
@@ -113,54 +139,50 @@ def patch_netcdf(nc_file_path):
     if 'expver' in ds.variables:
         ds = ds.drop('expver')
 
-    file_name = os.path.basename(nc_file_path)
-
-    if file_name in ['model_an.nc', 'eac4_ml.nc', 'egg4_ml.nc']:
-        new_ds = ds.rename({
-                'model_level': 'level',
-                'valid_time': 'time'})
+    new_ds = ds.rename(_rename_map[file_name])
 
-    elif file_name == 'pressure_an.nc':
-        new_ds = ds.rename({
-                'pressure_level': 'level',
-                'valid_time': 'time'})
-
-        # Yeah, somehow they thought it was a good idea to reverse the pressure levels......
+    # Yeah, somehow they thought it was a good idea to reverse the pressure levels......
+    if file_name == 'pressure_an.nc':
         new_ds = new_ds.reindex(level=new_ds.level[::-1])
 
-    elif file_name in ['surface_an.nc', 'surface_fc.nc', 'eac4_sfc.nc', 'egg4_sfc.nc', 'egg4_sl.nc']:
-        new_ds = ds.rename({
-                'valid_time': 'time'})
-
-    else:
-        error('Not a valid file type!')
-
     # Fix time. Old format was `hours since 1900-01-01 00:00:00.0`, new format `seconds since 1970-01-01`.
+    # The reference shift is constant, so it is added to the whole array at once
+    # instead of building a datetime.timedelta per timestep.
     old_ref = datetime.datetime(year=1900, month=1, day=1)
     new_ref = datetime.datetime(year=1970, month=1, day=1)
+    offset_hours = (new_ref - old_ref).total_seconds() / 3600.
 
-    new_ds['time'] = [(new_ref + datetime.timedelta(seconds=int(s)) - old_ref).total_seconds() / 3600. for s in new_ds.time.values]
+    new_ds['time'] = new_ds.time.values.astype(np.float64) / 3600. + offset_hours
     new_ds['time'].attrs['units'] = 'hours since 1900-01-01 00:00:00.0'
 
     # Remove Grib attributes.
     for v in new_ds.variables:
         da = new_ds[v]
 
-        to_rm = []
-        for attr in da.attrs:
-            if 'GRIB' in attr:
-                to_rm.append(attr)
-
-        for attr in to_rm:
+        for attr in [a for a in da.attrs if 'GRIB' in a]:
             del da.attrs[attr]
 
     # Remove dimensions of size 1.
     new_ds = new_ds.squeeze()
 
-    # Overwrite old file.
-    new_ds.to_netcdf(nc_file_path, format='NETCDF4_CLASSIC')
+    # Stream the patched file to a temporary sibling, chunk-by-chunk so memory
+    # stays bounded, then atomically replace the original. On failure, discard
+    # the half-written temporary and leave the original untouched.
+    tmp_file_path = f'{nc_file_path}.patching'
+
+    try:
+        delayed = new_ds.to_netcdf(
+                tmp_file_path, format='NETCDF4_CLASSIC',
+                encoding={'time': {'dtype': 'float64'}}, compute=False)
+        delayed.compute()
+    except Exception:
+        ds.close()
+        if os.path.isfile(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
 
-    return new_ds   # Just for debugging...
+    ds.close()
+    os.replace(tmp_file_path, nc_file_path)
 
 
 # from messages
@@ -210,22 +232,27 @@ def error(message, exit=True):
 #--------#
 
 def chunk_dates(dates, chunk_size):
-    """ Splits list of dates into lists of chunk_size. Prevents chunks from crossing between months. """
-    chunks, chunk = [], []
-    for d in dates:
-        if not chunk:
-            chunk.append(d)
-            continue
-
-        same_month = (d.month == chunk[-1].month)
-        chunk_size_reached = (len(chunk) >= chunk_size)
-
-        if (not same_month) or chunk_size_reached:
-            chunks.append(chunk)
-            chunk = [d]
-        else:
-            chunk.append(d)
-
-    if chunk:
-        chunks.append(chunk)
+    """
+    Splits list of dates into lists of chunk_size.
+    Prevents chunks from crossing between months (as this is not allowed by CDS API).
+    With chunk_size='month', one chunk per calendar month is returned (the CDS
+    recommendation for hourly data: fewer, larger requests use fewer queue slots).
+    The split points are found with NumPy rather than per-date Python comparisons.
+    """
+    if not dates:
+        return []
+
+    # Indices where a new (year, month) starts:
+    month_id = np.array([d.year * 12 + d.month for d in dates])
+    month_starts = np.concatenate(([0], np.flatnonzero(np.diff(month_id)) + 1, [len(dates)]))
+
+    if chunk_size == 'month':
+        return [dates[i0:i1] for i0, i1 in zip(month_starts[:-1], month_starts[1:])]
+
+    # Slice each month's run into chunks of at most chunk_size dates:
+    chunks = []
+    for i0, i1 in zip(month_starts[:-1], month_starts[1:]):
+        for j in range(i0, i1, chunk_size):
+            chunks.append(dates[j:min(j + chunk_size, i1)])
+
     return chunks